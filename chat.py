@@ -1,64 +1,93 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import atexit
+import contextlib
+import functools
 import logging
 import os
 import sys
+import time
 from rich.console import Console 
 from rich.markdown import Markdown
 from rich.panel import Panel
-from rich.status import Status
+from rich.live import Live
+from rich.spinner import Spinner
 import pyperclip
+import httpx
 import re
 import hashlib
 
-from mistralai.client import MistralClient
+from mistralai.async_client import MistralAsyncClient
 from mistralai.models.chat_completion import ChatMessage
 
 import readline
 readline.set_auto_history(True)
 
-MODEL_LIST = [
+# Persist the input history across sessions
+HISTORY_FILE = os.path.expanduser("~/.mistral_chat_history")
+HISTORY_LENGTH = 1000
+
+# Kept as a tuple so the models are always listed in the same order
+MODEL_LIST = (
     "mistral-tiny",
     "mistral-small",
     "mistral-medium",
-]
+)
+MODEL_SET = frozenset(MODEL_LIST)
 
 DEFAULT_MODEL = "mistral-small"
 
-COMMANDS = [
-    "/help",
-    "/quit",
-    "/model",
-    "/new",
-    "/copy",
-    "/ccopy"
-]
-
 CONSOLE = Console()
 
-# This is kind of weird, but if the status is active and the user CTRL+C the spinner wont stop
-# This way we can stop the spinner on CTRL+C
-STATUS = Status("Generating answers...", spinner="bouncingBall")
+HELP_TEXT = """
+To chat: type your message and hit enter
+To start a new chat: type /new
+To exit: /quit
+To show this help: /help
+To switch models: /model {model_name}
+Copy the last answer to your clipboard: /copy
+Copy a code block via a tag (always above the codeblock): /ccopy <code block tag>
+"""
+# The help never changes, so only build its panel once
+HELP_PANEL = Panel(HELP_TEXT, subtitle="/help", title="Help", border_style="purple")
+
+# Matches a whole code block, capturing the language tag and the code
+CODE_BLOCK_PATTERN = re.compile(r'```(\w*)([\s\S]*?)\s*```')
+# Matches every code block inside of a message
+CODE_BLOCK_PARSE_PATTERN = re.compile(r'```(?:\w+\s*)?\n([\s\S]*?)\s*```')
+
+# Re-render the markdown of a non-streamed answer every n chunks
+LIVE_UPDATE_CHUNKS = 16
+
+# Streamed output is written to stdout after this many seconds or buffered characters
+STREAM_FLUSH_INTERVAL = 0.03
+STREAM_FLUSH_SIZE = 256
+
+# Settings for the http client of the api, the connection is kept open between turns
+API_ENDPOINT = "https://api.mistral.ai"
+API_TIMEOUT = 120
+API_MAX_RETRIES = 5
+API_LIMITS = httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60.0)
+# Opening the connection on startup should never hold up the chat for longer than this
+WARMUP_TIMEOUT = 2
 
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 
 logger = logging.getLogger("chatbot")
 
 class CodeBlock:
-    tag = ""
-    raw_code = ""
-    code = ""
-    identifier = ""
-    
+    __slots__ = ("tag", "raw_code", "code", "identifier")
+
     def __init__(self, code: str):
         """
         A class for storing code codeblocks
         code (str): The actual code, including the ```
         """
         self.raw_code = code
-        self.tag, self.code = self._extract_code(self.raw_code)
-        self.identifier = self._generate_small_hash(self.raw_code)
+        self.tag, self.code = self._extract_code(code)
+        self.identifier = self._generate_small_hash(code)
 
 
     def _extract_code(self, input_string):
@@ -68,8 +97,7 @@ class CodeBlock:
         Returns:
             tag(str), code content(str)
         """
-        pattern = r'```(\w*)([\s\S]*?)\s*```'
-        match = re.search(pattern, input_string)
+        match = CODE_BLOCK_PATTERN.search(input_string)
 
         if match:
             tag = match.group(1).strip()
@@ -79,36 +107,14 @@ class CodeBlock:
             return None, None
         
     def _generate_small_hash(self, data):
-        """Generates a small hash from a string"""
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(data.encode('utf-8'))
-        small_hash = sha256_hash.hexdigest()[:8]  
-        return small_hash
-
-    @staticmethod
-    def parse_code_blocks(message: str) -> list:
-        """
-        Parses the give message to code CodeBlocks
-
-        Args:
-            message(str): The message to parse the code blocks from
-
-        Returns:
-            A list of parsed code blocks
-        """
-        pattern = r'```(?:\w+\s*)?\n([\s\S]*?)\s*```'
-        matches = re.finditer(pattern, message)
-
-        code_blocks = []
-        for match in matches:
-            text = match.group()
-            code_blocks.append(CodeBlock(text))
-
-        return code_blocks
-        
+        """Generates a small (8 hex chars) hash from a string"""
+        return hashlib.blake2b(data.encode('utf-8'), digest_size=4).hexdigest()
 
 
 class ChatBot:
+    # Maximum number of non-system messages that are sent to the api
+    MAX_HISTORY = 50
+
     def __init__(self, api_key: str, model: str, streamed: bool, system_message:str=None):
         """
         Initialises the chatbot
@@ -117,28 +123,65 @@ class ChatBot:
         streamed (bool): Wether the output should be streamed
         system_message (bool, Optional): The system message
         """
-        self.client = MistralClient(api_key=api_key)
+        # One event loop for the whole session so the client can keep its connections
+        self.loop = asyncio.new_event_loop()
+        self.client = MistralAsyncClient(api_key=api_key, endpoint=API_ENDPOINT,
+                                         max_retries=API_MAX_RETRIES, timeout=API_TIMEOUT)
+        self._keep_connection_alive()
         self.model = model
         self.system_message = system_message
         self.streamed = streamed
         self.first_chat = True
-        self.code_blocks = []
+        # Maps the identifier of a code block to the block itself
+        self.code_blocks: dict[str, CodeBlock] = {}
+        # Message factories with the role already bound, used for every turn
+        self._mk_user = functools.partial(ChatMessage, role="user")
+        self._mk_assistant = functools.partial(ChatMessage, role="assistant")
+        # Maps every command to its handler, each handler gets the list of args
+        self._cmd_table = {
+            "/new": lambda args: self.new_chat(),
+            "/quit": lambda args: self.exit(),
+            "/help": lambda args: self.print_help(),
+            "/model": self.switch_model,
+            "/copy": lambda args: self.copy_last_message(),
+            "/ccopy": self.copy_code,
+        }
+
+    def _keep_connection_alive(self):
+        """
+        Makes the api client reuse its connection between turns
+        """
+        # The sdk doesnt take a http client, so swap out its own one (with a 5s keepalive)
+        # for one that keeps the connection open while the user is typing
+        self._http_client = None
+        default_client = getattr(self.client, "_client", None)
+        if isinstance(default_client, httpx.AsyncClient):
+            self._http_client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=API_TIMEOUT,
+                transport=httpx.AsyncHTTPTransport(retries=API_MAX_RETRIES, limits=API_LIMITS),
+            )
+            self.client._client = self._http_client
+            self.loop.run_until_complete(default_client.aclose())
+
+    def _warm_up_connection(self):
+        """
+        Opens the connection to the api right away, so the first message doesnt have to wait for the handshake
+        """
+        if self._http_client is None:
+            return
+        # Use the http client directly so the sdk's retries cant hold up the startup
+        warmup = asyncio.wait_for(self._http_client.head(API_ENDPOINT), WARMUP_TIMEOUT)
+        try:
+            self._run(warmup)
+        except (Exception, KeyboardInterrupt) as e:
+            logger.debug("Warmup request failed: %r", e)
 
     def print_help(self):
         """
         Prints out the help message
         """
-        help_message = """
-To chat: type your message and hit enter
-To start a new chat: type /new
-To exit: /quit
-To show this help: /help
-To switch models: /model {model_name}
-Copy the last answer to your clipboard: /copy
-Copy a code block via a tag (always above the codeblock): /ccopy <code block tag>
-"""
-        help_panel = Panel(help_message, subtitle="/help", title="Help", border_style="purple")
-        CONSOLE.print(help_panel)
+        CONSOLE.print(HELP_PANEL)
 
     def new_chat(self):
         """
@@ -146,7 +189,6 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
         """
         CONSOLE.print("Starting new chat...")
         self.messages = []
-        readline.clear_history()
         if not self.first_chat:
             CONSOLE.clear()
         self.first_chat = False
@@ -160,10 +202,14 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
         Returns:
             bool, True if content is a command
         """
-        normalized_content = content.lower().strip()
-        command_parts = normalized_content.split(" ")
-        if command_parts[0] in COMMANDS:
-            self.handle_command(command_parts[0], command_parts[1::])
+        stripped = content.lstrip()
+        # Only the first word can be a command, so dont touch the rest of normal messages
+        if not stripped.startswith("/"):
+            return False
+        head, *rest = stripped.split(None, 1)
+        handler = self._cmd_table.get(head.lower())
+        if handler is not None:
+            handler(rest[0].lower().split() if rest else [])
             return True
         return False
 
@@ -192,7 +238,7 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
             return
 
         model_name = args[0]
-        if model_name not in MODEL_LIST:
+        if model_name not in MODEL_SET:
             print(f"Invalid model name {model_name}")
             self.print_available_models()
             return
@@ -209,14 +255,22 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
         pyperclip.copy(last_message)
 
     def copy_code(self, args):
+        """
+        Copies the code of a code block to the clipboard
+        Args:
+            args (list): The list of args passed on from handle_command.
+                         args[0] should be the identifier of the code block
+        """
         if len(args) < 1:
             print("No identifier specified")
+            return
         identifier = args[0]
-        for block in self.code_blocks:
-            if block.identifier == identifier:
-                pyperclip.copy(block.code)
-                print(f"Copied {identifier}")
-                return
+        block = self.code_blocks.get(identifier)
+        if block is None:
+            print(f"No code block with identifier {identifier}")
+            return
+        pyperclip.copy(block.code)
+        print(f"Copied {identifier}")
 
 
     def handle_command(self, command, args):
@@ -226,74 +280,185 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
             command (str): The actual command
             args (list): The list of args from the command
         """
-        match command:
-            case "/new":
-                self.new_chat()
-            case "/quit":
-                self.exit()
-            case "/help":
-                self.print_help()
-            case "/model":
-                self.switch_model(args)
-            case "/copy":
-                self.copy_last_message()
-            case "/ccopy":
-                self.copy_code(args)
-
-    def inject_code_blocks(self, code_blocks: list[CodeBlock], message: str) -> str:
-        # Find the first newline
-        new_message = message
-        for block in code_blocks:
-            raw_code_block_code = block.raw_code
+        self._cmd_table[command](args)
+
+    def _process_answer(self, answer: str) -> str:
+        """
+        Parses the code blocks of an answer, stores them and injects their identifiers
+        in a single pass over the answer
+        Args:
+            answer (str): The answer of the model
+
+        Returns:
+            The answer with the identifiers injected
+        """
+        # Most answers dont contain any code, so skip the regex for those
+        if "```" not in answer:
+            return answer
+
+        def store_and_inject(match):
+            block = CodeBlock(match.group())
+            self.code_blocks[block.identifier] = block
             # Just prepend the identifier so it is on the line before
-            new_code = f"\n`{block.identifier}`\n" + raw_code_block_code
-            new_message = new_message.replace(raw_code_block_code, new_code)
-        return new_message
+            return f"\n`{block.identifier}`\n{match.group()}"
 
-    def run_inference(self, content):
+        return CODE_BLOCK_PARSE_PATTERN.sub(store_and_inject, answer)
+
+    def _trim_history(self):
+        """
+        Drops the oldest messages so at most MAX_HISTORY messages (plus the system message) are kept
+        """
+        keep = []
+        if self.system_message and self.messages and self.messages[0].role == "system":
+            keep.append(self.messages[0])
+        tail = [message for message in self.messages if message.role != "system"][-self.MAX_HISTORY:]
+        # The conversation should still start with a message from the user
+        while tail and tail[0].role != "user":
+            tail.pop(0)
+        self.messages = keep + tail
+
+    async def _receive_stream(self, queue: asyncio.Queue):
+        """
+        Producer: reads the streamed chunks from the api and puts their content onto the queue
+        A None is put onto the queue once the stream is done
+        Args:
+            queue (asyncio.Queue): The queue shared with the consumer
+        """
+        try:
+            async for chunk in self.client.chat_stream(model=self.model, messages=self.messages):
+                response = chunk.choices[0].delta.content
+                if response is not None:
+                    await queue.put(response)
+        finally:
+            await queue.put(None)
+
+    @staticmethod
+    def _answer_panel(answer: str) -> Panel:
+        """Creates the panel an answer is rendered in"""
+        return Panel(Markdown(answer), title="Mistral", border_style="bold blue")
+
+    async def _collect_stream(self, queue: asyncio.Queue, live: Live = None):
+        """
+        Consumer: takes the content from the queue and assembles the answer
+        Args:
+            queue (asyncio.Queue): The queue shared with the producer
+            live (Live, Optional): If given the partial answer gets rendered into it
+
+        Returns:
+            The assembled answer(str)
+        """
+        answer_parts = []
+        # Streamed output is buffered so not every tiny chunk needs its own write
+        buffer = []
+        buffer_size = 0
+        last_flush = time.monotonic()
+
+        def flush():
+            nonlocal buffer_size, last_flush
+            sys.stdout.write("".join(buffer))
+            sys.stdout.flush()
+            buffer.clear()
+            buffer_size = 0
+            last_flush = time.monotonic()
+
+        try:
+            while True:
+                if buffer:
+                    # Dont keep buffered output back until the next chunk arrives
+                    timeout = max(0, last_flush + STREAM_FLUSH_INTERVAL - time.monotonic())
+                    try:
+                        response = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        flush()
+                        continue
+                else:
+                    response = await queue.get()
+                if response is None:
+                    break
+                answer_parts.append(response)
+                # If streamed output just output the buffered chunks every now and then
+                if self.streamed:
+                    buffer.append(response)
+                    buffer_size += len(response)
+                    if buffer_size > STREAM_FLUSH_SIZE:
+                        flush()
+                if live is not None and len(answer_parts) % LIVE_UPDATE_CHUNKS == 0:
+                    live.update(self._answer_panel("".join(answer_parts)))
+        finally:
+            # Write out whatever is left, even if the answer got interrupted
+            if buffer:
+                flush()
+        return "".join(answer_parts)
+
+    async def run_inference_async(self, content):
         """
         Makes the api call to run the model
+        The network stream and the assembling of the answer run as separate tasks
         Args:
             content (str): The message from the user
         """
-        self.messages.append(ChatMessage(role="user", content=content))
-
-        assistant_response = ""
-        answer = ""
-        logger.debug(f"Sending messages: {self.messages}")
-        # If we dont output streamed print a loading message so the user doesnt think nothings happening
-        if not args.streamed:
-            STATUS.start()
-        for chunk in self.client.chat_stream(model=self.model, messages=self.messages):
-            response = chunk.choices[0].delta.content
-            if response is not None:
-                assistant_response += response
-                # If streamed output just output with end="" via normal print
-                # If not streamed add it to the end string that will be printed out
-                if self.streamed:
-                    print(response, end="", flush=True)
-                answer += response
-        
-        # We are done so stop the loading
-        if not args.streamed:
-            STATUS.stop()
-
-        # We havent printed out the result so do it here
-        if not self.streamed:
-            # Parse the code blocks and inject the code block identifier
-            parsed_blocks = CodeBlock.parse_code_blocks(answer)
-            self.code_blocks += parsed_blocks
-            modified_answer = self.inject_code_blocks(parsed_blocks, answer)
-            markdown = Markdown(modified_answer)
-            panel = Panel(markdown, title="Mistral", border_style="bold blue")
-            CONSOLE.print(panel)
+        self.messages.append(self._mk_user(content=content))
+
+        logger.debug("Sending messages: %s", self.messages)
+        # If we dont output streamed render the answer live while it is generated
+        # Until the first chunks arrive show a loading message so the user doesnt think nothings happening
+        if self.streamed:
+            live_context = contextlib.nullcontext()
         else:
-            print("", flush=True)
+            spinner = Spinner("bouncingBall", text="Generating answers...")
+            live_context = Live(spinner, console=CONSOLE, refresh_per_second=8)
+        with live_context as live:
+            queue = asyncio.Queue()
+            producer = self.loop.create_task(self._receive_stream(queue))
+            consumer = self.loop.create_task(self._collect_stream(queue, live))
+            try:
+                answer = await consumer
+                await producer
+            finally:
+                # If one of them failed dont leave the other one (and the stream) open in the background
+                for task in (producer, consumer):
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(producer, consumer, return_exceptions=True)
+
+            # Render the final answer
+            if not self.streamed:
+                # Parse the code blocks and inject the code block identifier
+                modified_answer = self._process_answer(answer)
+                live.update(self._answer_panel(modified_answer))
+            else:
+                print("", flush=True)
+
+        if answer:
+            self.messages.append(self._mk_assistant(content=answer))
+        self._trim_history()
+        logger.debug("Current messages: %s", self.messages)
+
+    def run_inference(self, content):
+        """
+        Runs the inference on the event loop of the chatbot
+        Args:
+            content (str): The message from the user
+        """
+        self._run(self.run_inference_async(content))
 
+    def _run(self, coro):
+        """
+        Runs a coroutine on the event loop of the chatbot
+        Args:
+            coro: The coroutine to run
 
-        if assistant_response:
-            self.messages.append(ChatMessage(role="assistant", content=assistant_response))
-        logger.debug(f"Current messages: {self.messages}")
+        Returns:
+            The result of the coroutine
+        """
+        task = self.loop.create_task(coro)
+        try:
+            return self.loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            # Let the task unwind so the stream gets closed before the next message
+            task.cancel()
+            self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            raise
 
     def get_input(self, prompt: str):
         lines = [] 
@@ -305,8 +470,30 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
         return "\n".join(lines)
 
 
+    def _load_history(self):
+        """
+        Loads the input history of earlier sessions and saves it again on exit
+        """
+        try:
+            readline.read_history_file(HISTORY_FILE)
+        except OSError as e:
+            logger.debug("Could not read history file: %s", e)
+        readline.set_history_length(HISTORY_LENGTH)
+        atexit.register(self._save_history)
+
+    def _save_history(self):
+        """
+        Saves the input history for the next session
+        """
+        try:
+            readline.write_history_file(HISTORY_FILE)
+        except OSError as e:
+            logger.debug("Could not write history file: %s", e)
+
     def start(self):
+        self._load_history()
         self.print_help()
+        self._warm_up_connection()
         self.new_chat()
         while True:
             try:
@@ -321,7 +508,6 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
 
             # Dont stop on CTRL-C instead stop the current thing and print out a help message
             except KeyboardInterrupt:
-                STATUS.stop()
                 print("Use /quit to quit")
             except Exception as e:
                 print("Error: ", e)
@@ -329,6 +515,8 @@ Copy a code block via a tag (always above the codeblock): /ccopy <code block tag
 
     def exit(self):
         logger.debug("Exiting chatbot")
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
         sys.exit(0)
 
 
@@ -362,7 +550,7 @@ if __name__ == "__main__":
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    logger.debug(f"Starting chatbot with model: {args.model}")
+    logger.debug("Starting chatbot with model: %s", args.model)
 
     bot = ChatBot(args.api_key, args.model, args.streamed, args.system_message)
     bot.start()